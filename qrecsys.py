@@ -1,26 +1,41 @@
-import math
-from typing import List
+import os
+import tempfile
+import threading
+import warnings
+from collections import OrderedDict
 from pathlib import Path
+from typing import List
 
 import implicit
 import numpy as np
 import pandas as pd
+import tensorflow as tf
 import tensorflow_hub as hub
-from scipy.sparse import csr_matrix
-from sklearn.metrics.pairwise import euclidean_distances
+from scipy.sparse import coo_matrix
 
 EMBEDS_USE_URL = "https://tfhub.dev/google/universal-sentence-encoder/4"
+ENCODER_CACHE_SIZE = 4096
+
+# Loaded USE encoders, keyed by URL
+_ENCODERS = {}
 
 
 def preprocess(path_interactions: str = "interactions.csv",
                path_items: str = "items.csv",
                path_serialised: str = ".",
                embeds_use_url: str = EMBEDS_USE_URL,
-               embeds_mf_dim: int = 8):
+               embeds_mf_dim: int = 8,
+               num_threads: int = 0,
+               use_gpu: bool = implicit.cuda.HAS_CUDA,
+               batch_size: int = 512):
     """
     Read data, fit the data, convert title to USE & MF embeddings and
     serialise these embeddings.
 
+    Each file is written to a temporary file and then renamed into place,
+    so running `Recommender` instances that have memory-mapped the previous
+    embeddings keep reading them until they are re-created.
+
     Args:
         path_interactions (str, optional): Path to interactions file.
             Defaults to "interactions.csv".
@@ -32,6 +47,12 @@ def preprocess(path_interactions: str = "interactions.csv",
             from TF Hub. Defaults to EMBEDS_USE_URL (version 4).
         embeds_mf_dim (int, optional): The no. of dimensions of the MF embedding.
             Defaults to 8.
+        num_threads (int, optional): The no. of threads used to fit the MF
+            model. 0 uses all available cores. Defaults to 0.
+        use_gpu (bool, optional): Whether to fit the MF model on the GPU.
+            Defaults to True if implicit was built with CUDA support.
+        batch_size (int, optional): The no. of titles encoded by USE per
+            batch. Defaults to 512.
 
     Raises:
         FileNotFoundError: If "path_interactions" is invalid.
@@ -62,32 +83,46 @@ def preprocess(path_interactions: str = "interactions.csv",
     if "title" not in df_items.columns:
         raise ColumnNotFoundError("`title` must be present in items")
 
-    # Aggregate interactions data
-    df_intxn = df_intxn.groupby(["user","item"]).sum().reset_index()
-
     # Format to usable data
-    # Titles are batched to encoder the titles
-    # CSR matrix is a sparse matrix that is used in implicit
+    # Titles are batched and prefetched to feed the encoder
+    # CSR matrix is a sparse matrix that is used in implicit. Repeated
+    # interactions are aggregated as duplicates are summed by `tocsr`
     titles = df_items["title"].tolist()
-    batched_titles = batch(titles)
-    mat = csr_matrix(
-        (df_intxn["interaction"], (df_intxn["item"], df_intxn["user"])))
+    batched_titles = tf.data.Dataset.from_tensor_slices(titles) \
+        .batch(batch_size) \
+        .prefetch(tf.data.experimental.AUTOTUNE)
+    n_items = max(len(df_items), df_intxn["item"].max()+1)
+    n_users = df_intxn["user"].max()+1
+    mat = coo_matrix(
+        (df_intxn["interaction"].to_numpy(np.float32),
+         (df_intxn["item"].to_numpy(np.int32),
+          df_intxn["user"].to_numpy(np.int32))),
+        shape=(n_items, n_users)).tocsr()
 
     # USE model
-    model_use = hub.load(embeds_use_url)
+    model_use = _get_encoder(embeds_use_url)
 
     # MF Model
-    model_mf = implicit.als.AlternatingLeastSquares(factors=embeds_mf_dim)
+    model_mf = implicit.als.AlternatingLeastSquares(
+        factors=embeds_mf_dim,
+        use_native=True,
+        use_cg=True,
+        use_gpu=use_gpu,
+        num_threads=num_threads)
     model_mf.fit(mat)
 
     # Title embeddings encoded using USE & MF respectively
-    embeds_use = [model_use(batched).numpy() for batched in batched_titles]
-    embeds_use = np.vstack(embeds_use)
+    embeds_use = np.concatenate(
+        [model_use(batched).numpy() for batched in batched_titles])
     embeds_mf = model_mf.item_factors.copy()
 
     # Serialise embeddings
-    np.save(path_serialised/"embeds_use.npy", embeds_use)
-    np.save(path_serialised/"embeds_mf.npy", embeds_mf)
+    _save_atomic(path_serialised/"embeds_use.npy",
+                 embeds_use.astype(np.float32))
+    _save_atomic(path_serialised/"embeds_mf.npy",
+                 embeds_mf.astype(np.float32))
+    _save_atomic(path_serialised/"interacted_items.npy",
+                 np.unique(df_intxn["item"].to_numpy(np.int32)))
 
 
 class Recommender:
@@ -101,12 +136,39 @@ class Recommender:
         path_interactions = Path(path_interactions)
         path_embeds_mf = Path(path_serialised)/"embeds_mf.npy"
         path_embeds_use = Path(path_serialised)/"embeds_use.npy"
-
-        self.encoder = hub.load(EMBEDS_USE_URL)
-        self.embeds_mf = np.load(path_embeds_mf)
-        self.embeds_use = np.load(path_embeds_use)
-        self.items = pd.read_csv(path_items, index_col="id")
-        self.interacted_items = set(pd.read_csv(path_interactions)["item"])
+        path_interacted = Path(path_serialised)/"interacted_items.npy"
+
+        self.encoder = _get_encoder(EMBEDS_USE_URL)
+        self._encoded_queries = OrderedDict()
+        self._encoded_queries_lock = threading.Lock()
+        # Embeddings are memory-mapped so that forked workers share pages.
+        # Files serialised as float32 are used as-is without being copied
+        self.embeds_mf = np.ascontiguousarray(
+            np.load(path_embeds_mf, mmap_mode="r"), dtype=np.float32)
+        self.embeds_use = np.ascontiguousarray(
+            np.load(path_embeds_use, mmap_mode="r"), dtype=np.float32)
+        df_items = pd.read_csv(path_items, index_col="id")
+        self.titles = np.empty(df_items.index.max()+1, dtype=object)
+        self.titles[df_items.index.values] = df_items["title"].values
+
+        # Fall back to the interactions file for data serialised before
+        # interacted items were saved by `preprocess`
+        if path_interacted.exists():
+            interacted_ids = np.load(path_interacted)
+        else:
+            interacted_ids = pd.read_csv(path_interactions)["item"].unique()
+
+        self.interacted_ids = np.sort(
+            interacted_ids[interacted_ids < len(self.embeds_use)])
+        self.half_norms_mf = 0.5 * (self.embeds_mf**2).sum(axis=1)
+        self.half_norms_use = 0.5 * (self.embeds_use**2).sum(axis=1)
+
+        # Only items that have been interacted with can be recommended, so
+        # the rest are ranked last in the USE search. All N embeddings are
+        # still scanned, which keeps them memory-mapped instead of copied
+        not_interacted = np.ones(len(self.embeds_use), dtype=bool)
+        not_interacted[self.interacted_ids] = False
+        self.half_norms_use[not_interacted] = np.inf
 
     def recommend(self,
                   query: str,
@@ -126,8 +188,10 @@ class Recommender:
                 similarity. Defaults to 5.
             n_to_recommend (int, optional): The no. of recommendations that will
                 be generated. Defaults to 5.
-            use_buffer_multiplier (int, optional): this is needed because we will
-                filter out items that have not been interacted. Defaults to 1000.
+            use_buffer_multiplier (int, optional): Deprecated and has no
+                effect. Items that have not been interacted with are ranked
+                last in the USE search, so exactly `K_use` interacted items
+                are retrieved without a buffer. Defaults to 10.
             mf_buffer_multiplier (int, optional): this is needed because we need to
                 ensure the similar mf items don't already exist in the final
                 recommendations. Defaults to 10.
@@ -135,75 +199,186 @@ class Recommender:
         Returns:
             list: item recommendations as item IDs
         """
-        # Get encoding
-        encoded_query = self.encoder([query])
-        encoded_query = encoded_query.numpy()
-
-        # 1. Get nearest USE items
-        item_ids = self._find_nearest(
-            encoded_query,
-            self.embeds_use,
-            K=K_use*use_buffer_multiplier)
+        if use_buffer_multiplier != 10:
+            warnings.warn(
+                "`use_buffer_multiplier` is deprecated and has no effect",
+                DeprecationWarning,
+                stacklevel=2)
+        return self.recommend_batch(
+            [query],
+            K_use=K_use,
+            K_mf=K_mf,
+            n_to_recommend=n_to_recommend,
+            mf_buffer_multiplier=mf_buffer_multiplier)[0]
+
+    def recommend_batch(self,
+                        queries: List[str],
+                        *,
+                        K_use: int = 2,
+                        K_mf: int = 5,
+                        n_to_recommend: int = 5,
+                        mf_buffer_multiplier: int = 10) -> List[list]:
+        """Generate a list of recommendations for each of several search
+        queries. The queries are encoded together and every nearest
+        neighbour search is done as a single matrix product across queries.
 
-        # 2. Filter out to items that have not been interacted with
-        item_ids = [item_id for item_id in item_ids
-                    if item_id in self.interacted_items]
-
-        # 3. Get top `K_use`
-        item_ids = item_ids[:K_use]
+        Args:
+            queries (List[str]): Search queries to provide context.
+            K_use, K_mf, n_to_recommend, mf_buffer_multiplier:
+                See `recommend`.
 
-        # 4. For every item, get `K_mf` neighbours in the MF space
-        recs = []
-        for item_id in item_ids:
-            mf_items = self._find_nearest(
-                self.embeds_mf[None, item_id],
-                self.embeds_mf,
-                K=K_mf*mf_buffer_multiplier)
-            rec = np.setdiff1d(mf_items, recs, assume_unique=True)[:K_mf]
-            recs.extend(rec)
+        Returns:
+            List[list]: item recommendations for every query, in the same
+                order as `queries`
+        """
+        if not queries:
+            return []
 
-        # 5. Truncate
-        recs = recs[:n_to_recommend]
+        # Get encodings
+        encoded_queries = self._encode(queries)
 
-        # 6. Get titles
-        recs_titles = [self.items.loc[idx].item() for idx in recs]
+        # 1. Get top `K_use` nearest USE items that have been interacted with
+        item_ids = self._find_nearest(
+            encoded_queries,
+            self.embeds_use,
+            self.half_norms_use,
+            K=min(K_use, len(self.interacted_ids)))
+
+        # 2. For every item, get `K_mf` neighbours in the MF space
+        neighbours = self._find_nearest(
+            self.embeds_mf[item_ids.ravel()],
+            self.embeds_mf,
+            self.half_norms_mf,
+            K=K_mf*mf_buffer_multiplier)
+        neighbours = neighbours.reshape(*item_ids.shape, neighbours.shape[1])
+
+        recs_titles = []
+        for query_neighbours in neighbours:
+            recs = []
+            seen = np.zeros(len(self.embeds_mf), dtype=bool)
+            for mf_items in query_neighbours:
+                rec = mf_items[~seen[mf_items]][:K_mf]
+                seen[rec] = True
+                recs.extend(rec.tolist())
+
+            # 3. Truncate
+            recs = recs[:n_to_recommend]
+
+            # 4. Get titles
+            recs_titles.append(self.titles[recs].tolist())
 
         return recs_titles
 
+    def _encode(self, queries: List[str]) -> np.ndarray:
+        """Encode queries using USE, reusing the encodings of the
+        `ENCODER_CACHE_SIZE` most recently seen queries. Queries that are
+        not cached are encoded in a single call.
 
-    def _find_nearest(self, x, y, K: int) -> list:
-        """Find K nearest neighbours from a list of embeddings given a query.
-        Similarity metric is calculated using Euclidean distance.
+        Args:
+            queries (List[str]): Search queries
+
+        Returns:
+            np.ndarray: Query embeddings of shape (n_queries, dim)
+        """
+        # Cache hits are copied to a local dict under the lock, so concurrent
+        # calls evicting them while the encoder runs cannot affect this call
+        encoded = {}
+        with self._encoded_queries_lock:
+            for query in dict.fromkeys(queries):
+                if query in self._encoded_queries:
+                    self._encoded_queries.move_to_end(query)
+                    encoded[query] = self._encoded_queries[query]
+        new_queries = [query for query in dict.fromkeys(queries)
+                       if query not in encoded]
+
+        if new_queries:
+            encoded_new = self.encoder(new_queries).numpy().astype(np.float32)
+            # Cache copies of each row so that one cached entry does not
+            # keep the whole batch alive, and make them read-only
+            for query, encoded_query in zip(new_queries, encoded_new):
+                encoded_query = encoded_query.copy()
+                encoded_query.setflags(write=False)
+                encoded[query] = encoded_query
+            with self._encoded_queries_lock:
+                for query in new_queries:
+                    self._encoded_queries[query] = encoded[query]
+                while len(self._encoded_queries) > ENCODER_CACHE_SIZE:
+                    self._encoded_queries.popitem(last=False)
+
+        return np.stack([encoded[query] for query in queries])
+
+    def _find_nearest(self, x, y, half_norms, K: int) -> np.ndarray:
+        """Find K nearest neighbours from a list of embeddings for every
+        query. Similarity metric is calculated using Euclidean distance.
+
+        Since ||x - y||^2 = ||x||^2 + 2 * (||y||^2 / 2 - <x, y>) and ||x||^2 is
+        the same for every candidate, ranking by ||y||^2 / 2 - <x, y> gives
+        the same neighbours as ranking by Euclidean distance.
 
         Args:
-            x (array-like): Query embedding
+            x (array-like): Query embeddings of shape (n_queries, dim)
             y (array-like): A list of embeddings
+            half_norms (array-like): Precomputed ||y||^2 / 2 for every
+                embedding in `y`
             K (int): No. of neighbours to retrieve
 
         Returns:
-            list: Nearest neighbours
+            np.ndarray: Nearest neighbours of every query, nearest first,
+                of shape (n_queries, K)
         """
-        dists = euclidean_distances(x, y)
-        sorted_items = np.argsort(dists)[::-1]
-        return sorted_items[0][:K]
-
-
-def batch(items: List[str], batch_size=32) -> List[List[str]]:
-    """Batch a list of strings to a list of lists having a maximum
-    of 32 items.
+        # One GEMM for all queries, then subtract in place to avoid
+        # another (n_queries, N) temporary
+        scores = x @ y.T
+        np.subtract(half_norms, scores, out=scores)
+        K = min(K, scores.shape[1])
+        # Select the K nearest in O(N), then only sort those K
+        nearest = np.argpartition(scores, K-1, axis=1)[:, :K]
+        order = np.argsort(
+            np.take_along_axis(scores, nearest, axis=1), axis=1)
+        return np.take_along_axis(nearest, order, axis=1)
+
+
+def _get_encoder(url: str):
+    """Load a USE encoder from TF Hub, or reuse it if it has already been
+    loaded. The encoder is wrapped in a `tf.function` with a fixed input
+    signature so that every call reuses the same traced graph.
 
     Args:
-        items (List[str]): A list of items
-        batch_size (int, optional): Defaults to 32.
+        url (str): The URL of the USE encoder model on TF Hub
 
     Returns:
-        List[List[str]]: A list of batched items
+        Callable: Encoder taking a 1-D string tensor and returning its
+            embeddings
+    """
+    if url not in _ENCODERS:
+        model = hub.load(url)
+
+        @tf.function(input_signature=[tf.TensorSpec([None], tf.string)])
+        def encode(texts):
+            return model(texts)
+
+        _ENCODERS[url] = encode
+    return _ENCODERS[url]
+
+
+def _save_atomic(path: Path, array: np.ndarray):
+    """Save an array to a .npy file by writing a temporary file in the same
+    directory and renaming it over `path`. Existing memory maps of `path`
+    keep referring to the old file instead of seeing it truncated.
+
+    Args:
+        path (Path): Path of the .npy file
+        array (np.ndarray): Array to save
     """
-    num_batches = math.ceil(len(items) / batch_size)
-    batched_items = [
-        items[batch_size*batch_idx:batch_size*(batch_idx+1)]
-        for batch_idx in range(num_batches)]
-    return batched_items
+    fd, path_tmp = tempfile.mkstemp(
+        dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(path_tmp, path)
+    except BaseException:
+        os.unlink(path_tmp)
+        raise
 
 
 class ColumnNotFoundError(Exception):